@@ -1,2 +1,15 @@
-#/bin/sh
-scp root@andrewyu.org:/srv/powermentor/mentorweb/yay.db yay.db
+#!/bin/bash
+# Takes a consistent snapshot on the server rather than copying the live file,
+# and only replaces yay.db once the copy has been checked.
+set -euo pipefail
+trap 'rm -f yay.db.gz.tmp yay.db.tmp' EXIT
+ssh root@andrewyu.org 'cd /srv/powermentor/mentorweb && python3 server.py snapshot' > yay.db.gz.tmp
+gunzip -t yay.db.gz.tmp
+gunzip -c yay.db.gz.tmp > yay.db.tmp
+python3 -c '
+import sqlite3, sys
+check = sqlite3.connect("yay.db.tmp").execute("PRAGMA integrity_check").fetchall()
+if check != [("ok",)]:
+    sys.exit("snapshot failed integrity check: %r" % check)
+'
+mv yay.db.tmp yay.db
@@ -1,4 +1,14 @@
-CREATE TABLE users (username text primary key not null, argon2 text, cookietime real, cookie text, lastname text, firstname text, middlename text, subjects text, year TEXT);
-CREATE TABLE meetings (mid integer primary key, mentor text, mentee text, time_start integer, time_end integer, notes text);
-CREATE TABLE subjects (subjectid text primary key not null, subjectname text not null);
-CREATE TABLE subject_associations (username text, subjectid text);
+CREATE TABLE IF NOT EXISTS users (username text primary key not null, argon2 text, cookietime real, cookie text, lastname text, firstname text, middlename text, subjects text, year TEXT);
+CREATE TABLE IF NOT EXISTS meetings (mid integer primary key, mentor text, mentee text, time_start integer, time_end integer, notes text);
+CREATE TABLE IF NOT EXISTS subjects (subjectid text primary key not null, subjectname text not null);
+CREATE TABLE IF NOT EXISTS subject_associations (username text, subjectid text);
+CREATE INDEX IF NOT EXISTS meetings_time_start ON meetings (time_start);
+CREATE TABLE IF NOT EXISTS meeting_changes (cid integer primary key autoincrement, mid integer, kind text, mentor text, mentee text, time_start integer, time_end integer, time real);
+CREATE TABLE IF NOT EXISTS outbox (oid integer primary key, recipient text not null, subject text not null, body text not null, created real, attempts integer not null default 0, next_attempt real, sent real);
+CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (next_attempt) WHERE sent IS NULL;
+CREATE INDEX IF NOT EXISTS users_lastname ON users (lastname COLLATE NOCASE, firstname COLLATE NOCASE, middlename COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS users_firstname ON users (firstname COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS users_username ON users (username COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS subject_associations_username ON subject_associations (username);
+CREATE TABLE IF NOT EXISTS meeting_stats (subjectid text not null, year text not null, week text not null, slots integer not null default 0, claimed integer not null default 0, latency_sum real not null default 0, latency_count integer not null default 0, primary key (subjectid, year, week));
+CREATE INDEX IF NOT EXISTS meeting_stats_week ON meeting_stats (week);
@@ -29,8 +29,42 @@ from __future__ import annotations
 ADMINS = ["s22537", "s15155"]
 ALTLAW = False
 PRODUCTION = False # Non-HTTPS requests will not work if in production mode.
-
-from typing import Union, Optional, Tuple, List
+MONTH_CACHE_SIZE = 36 # Month grids kept, least recently used dropped first.
+CHANGES_MAX_WAIT = 60 # Longest long-poll on /changes.json, in seconds.
+CHANGES_PAGE = 500 # Most changes returned by one /changes.json response.
+SMTP_HOST = "localhost"
+SMTP_PORT = 25
+MAIL_FROM = "powermentor@andrewyu.org"
+OUTBOX_BATCH = 20 # Messages sent per SMTP connection.
+OUTBOX_RATE = 2.0 # Messages per second, at most.
+OUTBOX_RETRY = 60 # Seconds before the first retry; doubles on each failure.
+OUTBOX_ATTEMPTS = 8 # Messages are given up on after this many failures.
+OUTBOX_POLL = 30 # Seconds between outbox scans when nothing wakes the dispatcher.
+IMPERSONATE_PAGE = 50 # Users listed per page on /impersonate.
+IMPERSONATE_MAX_PAGE = 10000 # Larger page numbers are treated as this one.
+# Token buckets for expensive endpoints: the methods limited, then tokens per
+# second and burst size per client address, then the same per username given
+# in the form, or None for no per-username limit. The .ics feeds have none, as
+# anyone could then keep someone else's feed rejected.
+RATE_LIMITS = {
+    "login": (("POST",), 0.2, 10, 0.1, 5),
+    "calendar": (("GET",), 0.5, 30, None, None),
+}
+BUCKETS_PRUNE_INTERVAL = 10 # Seconds between sweeps for full, forgettable buckets.
+EXPENSIVE_CONCURRENCY = 8 # Rate-limited requests allowed to run at once.
+EXPENSIVE_WAIT = 0.5 # Seconds to wait for a free slot before answering 429.
+SNAPSHOT_DIR = "snapshots"
+SNAPSHOT_INTERVAL = 60 * 60 # Seconds between scheduled snapshots.
+SNAPSHOT_KEEP = 48 # Compressed snapshots kept; older ones are deleted.
+SNAPSHOT_PAGES = 64 # Pages copied per backup step; the database is free in between.
+SNAPSHOT_SLEEP = 0.05 # Seconds slept between backup steps.
+SNAPSHOT_RESTARTS = 20 # Restarts caused by writes before copying in one step instead.
+STATS_WEEKS_BACK = 8 # Past weeks shown on /stats.
+STATS_WEEKS_AHEAD = 4 # Future weeks shown on /stats.
+
+from typing import Union, Optional, Tuple, List, Dict, Any, Callable, TypeVar
+from functools import wraps
+from math import ceil
 from markupsafe import Markup
 from flask import (
     Flask,
@@ -44,13 +78,18 @@ from flask import (
 )
 from werkzeug.wrappers.response import Response as werkzeugResponse
 from werkzeug.middleware.proxy_fix import ProxyFix
-from datetime import datetime
-from time import time
+from datetime import datetime, date, timedelta
+from calendar import Calendar
+from collections import OrderedDict
+from time import time, sleep
 from secrets import token_urlsafe
+from email.message import EmailMessage
 from argon2 import PasswordHasher
 from argon2.exceptions import VerifyMismatchError
 from jinja2 import StrictUndefined
 import sqlite3
+import smtplib
+import threading
 import requests
 import logging
 
@@ -58,14 +97,54 @@ logging.basicConfig(level=logging.DEBUG)
 # logging.getLogger("werkzeug").setLevel(logging.WARNING)
 import ics
 import re
+import os
+import sys
+import gzip
+import shutil
 
 app = Flask(__name__)
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_prefix=1)  # type: ignore
 app.jinja_env.undefined = StrictUndefined
 
 con = sqlite3.connect("yay.db", check_same_thread=False)
+
+
+def migrate() -> None:
+    # Every statement in schema.sql is idempotent, so this brings an existing
+    # database up to date with tables and indexes added since it was created.
+    had_stats = con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'meeting_stats'"
+    ).fetchall()
+    with open(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema.sql")
+    ) as schema:
+        con.executescript(schema.read())
+    # Every meeting has a row in meeting_stats, so empty summaries next to
+    # meetings mean they were never filled in, and updating them
+    # incrementally would only make the counts go negative.
+    if not had_stats or (
+        con.execute("SELECT 1 FROM meetings LIMIT 1").fetchall()
+        and not con.execute("SELECT 1 FROM meeting_stats LIMIT 1").fetchall()
+    ):
+        rebuild_meeting_stats()
 null_lfmu = ("None", "None", "(None)", "none")
 
+# Bumped whenever the meetings table changes, so that derived caches such as
+# the month grids know when to rebuild.
+meetings_version = 0
+month_cache: OrderedDict[
+    Tuple[int, int], Tuple[int, List[List[Tuple[date, List[Any]]]]]
+] = OrderedDict()
+meetings_condition = threading.Condition()
+outbox_wakeup = threading.Event()
+# Each bucket is (tokens, last update, time it will be full again).
+buckets: Dict[Tuple[str, str, str], Tuple[float, float, float]] = {}
+buckets_pruned = 0.0
+buckets_lock = threading.Lock()
+expensive_slots = threading.BoundedSemaphore(EXPENSIVE_CONCURRENCY)
+snapshot_lock = threading.Lock()
+rejections: Dict[str, int] = {}
+
 
 class GeneralFault(Exception):
     pass
@@ -79,6 +158,10 @@ class DatabaseFault(GeneralFault):
     pass
 
 
+class SnapshotRestarted(DatabaseFault):
+    pass
+
+
 def check_login(username: str, password: str) -> None:
     try:
         target = con.execute(
@@ -129,6 +212,285 @@ def record_cookie(username: str, cookie: str) -> None:
         return
 
 
+def record_meeting_change(mid: Union[int, str], kind: str) -> None:
+    # Must run inside the transaction that makes the change, and while the
+    # meeting row still names everyone who should see the change.
+    assert kind in ("insert", "claim", "release", "delete")
+    assert (
+        con.execute(
+            "INSERT INTO meeting_changes (mid, kind, mentor, mentee, time_start, time_end, time) SELECT mid, ?, mentor, mentee, time_start, time_end, ? FROM meetings WHERE mid = ?",
+            (kind, time(), mid),
+        ).rowcount
+        == 1
+    )
+
+
+def queue_meeting_mail(
+    recipient: Optional[str],
+    actor: str,
+    mid: Union[int, str],
+    time_start: int,
+    what: str,
+    reason: str = "",
+) -> None:
+    # Must run inside the transaction that makes the change, so that the mail
+    # is sent if and only if the change is committed.
+    if not recipient:
+        return
+    lfmu = get_lfmu(actor)
+    body = "%s, %s %s %s your meeting %s starting %s.\n" % (
+        lfmu[0],
+        lfmu[1],
+        lfmu[2],
+        what,
+        mid,
+        datetime.fromtimestamp(time_start).strftime("%c"),
+    )
+    if reason:
+        body += "\nReason given:\n%s\n" % reason
+    body += "\nhttps://powermentor.andrewyu.org/\n"
+    con.execute(
+        "INSERT INTO outbox (recipient, subject, body, created, attempts, next_attempt) VALUES (?, ?, ?, ?, 0, ?)",
+        (
+            "%s@ykpaoschool.cn" % recipient,
+            "Peer Pao: %s, %s %s %s your meeting" % (lfmu[0], lfmu[1], lfmu[2], what),
+            body,
+            time(),
+            time(),
+        ),
+    )
+
+
+def send_outbox_batch(
+    dcon: sqlite3.Connection, batch: List[Tuple[int, str, str, str, int]]
+) -> None:
+    try:
+        smtp = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=30)
+    except OSError as e:
+        logging.warning("outbox: cannot connect to %s:%d: %s" % (SMTP_HOST, SMTP_PORT, e))
+        for oid, _, _, _, attempts in batch:
+            dcon.execute(
+                "UPDATE outbox SET attempts = ?, next_attempt = ? WHERE oid = ?",
+                (attempts + 1, time() + OUTBOX_RETRY * 2**attempts, oid),
+            )
+        dcon.commit()
+        return
+    try:
+        for oid, recipient, subject, body, attempts in batch:
+            msg = EmailMessage()
+            msg["From"] = MAIL_FROM
+            msg["To"] = recipient
+            msg["Subject"] = subject
+            msg.set_content(body)
+            try:
+                smtp.send_message(msg)
+            except (smtplib.SMTPException, OSError) as e:
+                logging.warning("outbox: failed to send %d to %s: %s" % (oid, recipient, e))
+                dcon.execute(
+                    "UPDATE outbox SET attempts = ?, next_attempt = ? WHERE oid = ?",
+                    (attempts + 1, time() + OUTBOX_RETRY * 2**attempts, oid),
+                )
+                # SMTPException is an OSError too; only a lost connection
+                # should give up on the rest of the batch.
+                if isinstance(e, smtplib.SMTPServerDisconnected) or not isinstance(
+                    e, smtplib.SMTPException
+                ):
+                    dcon.commit()
+                    return
+            else:
+                dcon.execute("UPDATE outbox SET sent = ? WHERE oid = ?", (time(), oid))
+            dcon.commit()
+            sleep(1 / OUTBOX_RATE)
+    finally:
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+
+def send_outbox(dcon: sqlite3.Connection) -> None:
+    # Sends everything that is due, one batch per SMTP connection.
+    while True:
+        batch = dcon.execute(
+            "SELECT oid, recipient, subject, body, attempts FROM outbox WHERE sent IS NULL AND next_attempt <= ? AND attempts < ? ORDER BY next_attempt ASC LIMIT ?",
+            (time(), OUTBOX_ATTEMPTS, OUTBOX_BATCH),
+        ).fetchall()
+        if not batch:
+            break
+        send_outbox_batch(dcon, batch)
+
+
+def dispatch_outbox() -> None:
+    # Runs in its own thread with its own connection, so that slow or broken
+    # SMTP never holds up a request.
+    dcon = sqlite3.connect("yay.db")
+    while True:
+        outbox_wakeup.wait(OUTBOX_POLL)
+        outbox_wakeup.clear()
+        try:
+            send_outbox(dcon)
+        except Exception:
+            # Keep the thread alive whatever happens, e.g. "database is
+            # locked"; back off, then scan again.
+            logging.exception("outbox: dispatch failed")
+            try:
+                dcon.rollback()
+            except sqlite3.Error:
+                pass
+            sleep(OUTBOX_RETRY)
+            outbox_wakeup.set()
+
+
+def start_dispatcher() -> None:
+    threading.Thread(target=dispatch_outbox, name="outbox", daemon=True).start()
+    outbox_wakeup.set()
+
+
+def take_snapshot() -> str:
+    # Uses the online backup API from a connection of its own, a few pages at
+    # a time, so requests only ever wait for one step. Writers in between make
+    # SQLite restart the copy, which therefore always ends up consistent.
+    restarts = 0
+    last_remaining: Optional[int] = None
+
+    def progress(status: int, remaining: int, total: int) -> None:
+        # Python's own sleep argument only applies to BUSY and LOCKED steps.
+        nonlocal restarts, last_remaining
+        if last_remaining is not None and remaining > last_remaining:
+            restarts += 1
+            if restarts > SNAPSHOT_RESTARTS:
+                raise SnapshotRestarted(restarts)
+        last_remaining = remaining
+        if remaining:
+            sleep(SNAPSHOT_SLEEP)
+
+    with snapshot_lock:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        path = os.path.join(
+            SNAPSHOT_DIR, "yay-%s.db" % datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        )
+        src = sqlite3.connect("yay.db")
+        dst = sqlite3.connect(path + ".tmp")
+        try:
+            try:
+                src.backup(dst, pages=SNAPSHOT_PAGES, progress=progress)
+            except SnapshotRestarted:
+                # Steady writes would otherwise keep restarting the copy
+                # forever; take the whole database at once instead.
+                logging.warning(
+                    "snapshot: restarted more than %d times, copying in one step"
+                    % SNAPSHOT_RESTARTS
+                )
+                src.backup(dst)
+            check = dst.execute("PRAGMA integrity_check").fetchall()
+            if check != [("ok",)]:
+                raise DatabaseFault("snapshot failed integrity check", path, check)
+        finally:
+            dst.close()
+            src.close()
+        with open(path + ".tmp", "rb") as f, gzip.open(path + ".gz.tmp", "wb") as g:
+            shutil.copyfileobj(f, g)
+        os.remove(path + ".tmp")
+        os.replace(path + ".gz.tmp", path + ".gz")
+        for old in get_snapshots()[:-SNAPSHOT_KEEP]:
+            os.remove(os.path.join(SNAPSHOT_DIR, old))
+        return path + ".gz"
+
+
+def get_snapshots() -> List[str]:
+    try:
+        names = os.listdir(SNAPSHOT_DIR)
+    except FileNotFoundError:
+        return []
+    return sorted(n for n in names if n.startswith("yay-") and n.endswith(".db.gz"))
+
+
+def schedule_snapshots() -> None:
+    while True:
+        try:
+            logging.info("snapshot taken: %s" % take_snapshot())
+        except (sqlite3.Error, OSError, DatabaseFault) as e:
+            logging.error("snapshot failed: %s" % e)
+        sleep(SNAPSHOT_INTERVAL)
+
+
+def start_snapshots() -> None:
+    threading.Thread(target=schedule_snapshots, name="snapshots", daemon=True).start()
+
+
+def meetings_changed() -> None:
+    global meetings_version
+    with meetings_condition:
+        meetings_version += 1
+        month_cache.clear()
+        meetings_condition.notify_all()
+
+
+def take_token(key: Tuple[str, str, str], rate: float, burst: int) -> float:
+    # Returns zero if a token was taken, or else the seconds until one will
+    # be available.
+    global buckets_pruned
+    now = time()
+    with buckets_lock:
+        if now - buckets_pruned > BUCKETS_PRUNE_INTERVAL:
+            # A full bucket is the same as a missing one, so forget those.
+            # Sweeping only now and then keeps the cost per request constant.
+            for k in [k for k, b in buckets.items() if b[2] <= now]:
+                del buckets[k]
+            buckets_pruned = now
+        tokens, last, _ = buckets.get(key, (burst, now, now))
+        tokens = min(burst, tokens + (now - last) * rate)
+        wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+        if not wait:
+            tokens -= 1
+        buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        return wait
+
+
+def too_many(counter: str, retry_after: float) -> Response:
+    with buckets_lock:
+        rejections[counter] = rejections.get(counter, 0) + 1
+    logging.warning("rejected %s from %s" % (counter, request.remote_addr))
+    response = make_response(
+        "Too many requests; please try again in a little while.", 429
+    )
+    response.headers["Retry-After"] = str(ceil(retry_after))
+    return response
+
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+def rate_limited(f: F) -> F:
+    name = f.__name__
+    methods, client_rate, client_burst, user_rate, user_burst = RATE_LIMITS[name]
+
+    @wraps(f)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        if request.method not in methods:
+            return f(*args, **kwargs)
+        wait = take_token(
+            (name, "client", request.remote_addr or ""), client_rate, client_burst
+        )
+        if wait:
+            return too_many(name + ":client", wait)
+        username = request.form.get("username")
+        if username and user_rate and user_burst:
+            wait = take_token((name, "username", username), user_rate, user_burst)
+            if wait:
+                return too_many(name + ":username", wait)
+        # Shed load rather than let expensive requests pile up behind each
+        # other and starve everything else.
+        if not expensive_slots.acquire(timeout=EXPENSIVE_WAIT):
+            return too_many(name + ":busy", 1)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            expensive_slots.release()
+
+    return wrapper  # type: ignore
+
+
 @app.route("/static/<path:path>", methods=["GET"])
 def static_(path: str) -> Response:
     return send_from_directory("static", path)
@@ -213,6 +575,7 @@ def mview(mid: str) -> Union[Response, werkzeugResponse, str]:
 
 
 @app.route("/<username>.ics")
+@rate_limited
 def calendar(username: str) -> Response:
     cal = ics.Calendar()
 
@@ -252,6 +615,182 @@ def calendar(username: str) -> Response:
     return response
 
 
+def get_month_grid(year: int, month: int) -> List[List[Tuple[date, List[Any]]]]:
+    with meetings_condition:
+        version = meetings_version
+        cached = month_cache.get((year, month))
+        if cached and cached[0] == version:
+            month_cache.move_to_end((year, month))
+            return cached[1]
+    weeks = Calendar(firstweekday=6).monthdatescalendar(year, month)
+    # The grid spans whole weeks, so the range covers the leading and trailing
+    # days of the neighbouring months too.
+    first = datetime.combine(weeks[0][0], datetime.min.time())
+    last = datetime.combine(weeks[-1][-1], datetime.min.time()) + timedelta(days=1)
+    by_day: Dict[date, List[Any]] = {}
+    for row in con.execute(
+        "SELECT mid, mentor, mentee, time_start, time_end, mr.lastname, mr.firstname, mr.middlename, me.lastname, me.firstname, me.middlename FROM meetings LEFT JOIN users AS mr ON mr.username = mentor LEFT JOIN users AS me ON me.username = mentee WHERE time_start >= ? AND time_start < ? ORDER BY time_start ASC",
+        (int(first.timestamp()), int(last.timestamp())),
+    ).fetchall():
+        by_day.setdefault(datetime.fromtimestamp(row[3]).date(), []).append(row)
+    grid = [[(day, by_day.get(day, [])) for day in week] for week in weeks]
+    with meetings_condition:
+        month_cache[(year, month)] = (version, grid)
+        # Any month may be asked for, so only keep the recently used ones.
+        while len(month_cache) > MONTH_CACHE_SIZE:
+            month_cache.popitem(last=False)
+    return grid
+
+
+def get_calendar(
+    username: str, year: int, month: int
+) -> List[List[Tuple[date, List[Dict[str, Any]]]]]:
+    now = time()
+    weeks = []
+    for week in get_month_grid(year, month):
+        days = []
+        for day, rows in week:
+            entries = []
+            for mid, mentor, mentee, time_start, time_end, *names in rows:
+                if mentor == username:
+                    role = "mentor"
+                    other = names[3:] if mentee else None
+                elif mentee == username:
+                    role = "mentee"
+                    other = names[:3]
+                elif not mentee and (ALTLAW or time_end > now):
+                    role = "open"
+                    other = names[:3]
+                else:
+                    continue
+                entries.append(
+                    {
+                        "mid": mid,
+                        "role": role,
+                        "other": other,
+                        "time_start": time_start,
+                        "time_end": time_end,
+                        "start": datetime.fromtimestamp(time_start).strftime("%H:%M"),
+                        "end": datetime.fromtimestamp(time_end).strftime("%H:%M"),
+                    }
+                )
+            days.append((day, entries))
+        weeks.append(days)
+    return weeks
+
+
+def get_requested_month() -> Tuple[int, int]:
+    if not request.args.get("month"):
+        today = date.today()
+        return today.year, today.month
+    requested = datetime.strptime(request.args["month"], "%Y-%m")
+    if not 1970 <= requested.year < 9999:
+        raise ValueError(requested.year)
+    return requested.year, requested.month
+
+
+@app.route("/calendar")
+def month_view() -> Union[Response, werkzeugResponse, str]:
+    snotes: List[Union[str, Markup]] = []
+    if ALTLAW:
+        snotes.append("Alternate law is enabled for testing and demonstration – you may see unnecessary information (such as the inclusion of expired meetings) or other abnormal behaviour.")
+    try:
+        username = check_cookie(request.cookies.get("session-id"))
+    except AuthenticationFault:
+        return redirect("/login")
+    lfmu = get_lfmu(username)
+    try:
+        year, month = get_requested_month()
+    except ValueError:
+        snotes.append(
+            "The month you asked for was unreadable, so you are seeing the current month instead."
+        )
+        year, month = date.today().year, date.today().month
+
+    return render_template(
+        "calendar.html",
+        lfmu=lfmu,
+        snotes=snotes,
+        title=date(year, month, 1).strftime("%B %Y"),
+        month=month,
+        prev_month="%04d-%02d" % ((year - 1, 12) if month == 1 else (year, month - 1)),
+        next_month="%04d-%02d" % ((year + 1, 1) if month == 12 else (year, month + 1)),
+        weeks=get_calendar(username, year, month),
+    )
+
+
+@app.route("/calendar.json")
+def month_view_json() -> Union[Dict[str, Any], Tuple[Dict[str, Any], int]]:
+    try:
+        username = check_cookie(request.cookies.get("session-id"))
+    except AuthenticationFault:
+        return {"error": "not logged in"}, 401
+    try:
+        year, month = get_requested_month()
+    except ValueError:
+        return {"error": "unreadable month"}, 400
+    return {
+        "year": year,
+        "month": month,
+        "weeks": [
+            [{"date": day.isoformat(), "meetings": entries} for day, entries in week]
+            for week in get_calendar(username, year, month)
+        ],
+    }
+
+
+def get_changes(username: str, since: int) -> List[Dict[str, Any]]:
+    changes = []
+    for cid, mid, kind, mentor, mentee, time_start, time_end, t in con.execute(
+        "SELECT cid, mid, kind, mentor, mentee, time_start, time_end, time FROM meeting_changes WHERE cid > ? ORDER BY cid ASC LIMIT ?",
+        (since, CHANGES_PAGE),
+    ).fetchall():
+        change = {
+            "cursor": cid,
+            "mid": mid,
+            "kind": kind,
+            "mentor": mentor,
+            "time_start": time_start,
+            "time_end": time_end,
+            "time": t,
+        }
+        # Everyone may see open slots come and go, but only the people in
+        # a meeting may see who the mentee is.
+        if username in (mentor, mentee):
+            change["mentee"] = mentee
+        changes.append(change)
+    return changes
+
+
+@app.route("/changes.json")
+def changes_json() -> Union[Dict[str, Any], Tuple[Dict[str, Any], int]]:
+    try:
+        username = check_cookie(request.cookies.get("session-id"))
+    except AuthenticationFault:
+        return {"error": "not logged in"}, 401
+    try:
+        since = int(request.args.get("since", 0))
+        wait = min(float(request.args.get("wait", 0)), CHANGES_MAX_WAIT)
+    except ValueError:
+        return {"error": "unreadable cursor or wait"}, 400
+    if not 0 <= since < 2**63:
+        return {"error": "cursor out of range"}, 400
+
+    version = meetings_version
+    changes = get_changes(username, since)
+    if not changes and wait > 0:
+        with meetings_condition:
+            meetings_condition.wait_for(
+                lambda: meetings_version != version, timeout=wait
+            )
+        changes = get_changes(username, since)
+    return {
+        "cursor": changes[-1]["cursor"] if changes else since,
+        "more": len(changes) == CHANGES_PAGE,
+        "changes": changes,
+    }
+
+
 def get_subjectname(subjectid: str) -> str:
     try:
         res = con.execute(
@@ -278,6 +817,88 @@ def get_subjectids(username: Optional[str] = None) -> list[str]:
     return res
 
 
+def get_week(timestamp: int) -> str:
+    day = datetime.fromtimestamp(timestamp).date()
+    return (day - timedelta(days=day.weekday())).isoformat()
+
+
+def get_claim_latency(mid: Union[int, str]) -> Optional[float]:
+    res = con.execute(
+        "SELECT (SELECT max(time) FROM meeting_changes WHERE mid = ? AND kind = 'claim') - (SELECT max(time) FROM meeting_changes WHERE mid = ? AND kind = 'insert')",
+        (mid, mid),
+    ).fetchone()[0]
+    assert (type(res) is float) or (res is None)
+    return res
+
+
+def count_meeting(mid: Union[int, str], sign: int) -> None:
+    # Adds (sign 1) or removes (sign -1) a meeting's share of meeting_stats.
+    # Changes are made by removing the meeting as it was and adding it back as
+    # it is, in the same transaction, so the summaries always match
+    # recompute_meeting_stats().
+    res = con.execute(
+        "SELECT mentor, mentee, time_start FROM meetings WHERE mid = ?", (mid,)
+    ).fetchall()
+    assert len(res) == 1
+    mentor, mentee, time_start = res[0]
+    claimed = 1 if mentee else 0
+    latency = get_claim_latency(mid) if claimed else None
+    year = get_yeargroup(mentor) or ""
+    for subjectid in get_subjectids(mentor) or [""]:
+        con.execute(
+            "INSERT INTO meeting_stats (subjectid, year, week, slots, claimed, latency_sum, latency_count) VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (subjectid, year, week) DO UPDATE SET slots = slots + excluded.slots, claimed = claimed + excluded.claimed, latency_sum = latency_sum + excluded.latency_sum, latency_count = latency_count + excluded.latency_count",
+            (
+                subjectid,
+                year,
+                get_week(time_start),
+                sign,
+                sign * claimed,
+                sign * (latency or 0.0),
+                sign if latency is not None else 0,
+            ),
+        )
+
+
+def recompute_meeting_stats() -> Dict[Tuple[str, str, str], List[float]]:
+    stats: Dict[Tuple[str, str, str], List[float]] = {}
+    for subjectid, year, time_start, claimed, latency in con.execute(
+        "SELECT coalesce(sa.subjectid, ''), coalesce(u.year, ''), m.time_start, coalesce(m.mentee, '') != '', CASE WHEN coalesce(m.mentee, '') != '' THEN (SELECT max(time) FROM meeting_changes WHERE mid = m.mid AND kind = 'claim') - (SELECT max(time) FROM meeting_changes WHERE mid = m.mid AND kind = 'insert') END FROM meetings AS m LEFT JOIN users AS u ON u.username = m.mentor LEFT JOIN subject_associations AS sa ON sa.username = m.mentor"
+    ).fetchall():
+        row = stats.setdefault((subjectid, year, get_week(time_start)), [0, 0, 0.0, 0])
+        row[0] += 1
+        row[1] += claimed
+        if latency is not None:
+            row[2] += latency
+            row[3] += 1
+    return stats
+
+
+def check_meeting_stats() -> List[str]:
+    expected = recompute_meeting_stats()
+    actual = {
+        (subjectid, year, week): [slots, claimed, latency_sum, latency_count]
+        for subjectid, year, week, slots, claimed, latency_sum, latency_count in con.execute(
+            "SELECT subjectid, year, week, slots, claimed, latency_sum, latency_count FROM meeting_stats"
+        ).fetchall()
+    }
+    problems = []
+    for key in sorted(set(expected) | set(actual)):
+        e = expected.get(key, [0, 0, 0.0, 0])
+        a = actual.get(key, [0, 0, 0.0, 0])
+        if e[0] != a[0] or e[1] != a[1] or e[3] != a[3] or abs(e[2] - a[2]) > 1e-3:
+            problems.append("%s %s %s: expected %r, found %r" % (key + (e, a)))
+    return problems
+
+
+def rebuild_meeting_stats() -> None:
+    con.execute("DELETE FROM meeting_stats")
+    con.executemany(
+        "INSERT INTO meeting_stats (subjectid, year, week, slots, claimed, latency_sum, latency_count) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [key + tuple(row) for key, row in recompute_meeting_stats().items()],
+    )
+    con.commit()
+
+
 @app.route("/expertise")
 def expertise() -> Union[Response, werkzeugResponse, str]:
     snotes: List[Union[str, Markup]] = []
@@ -388,14 +1009,15 @@ def enlist() -> Union[Response, werkzeugResponse, str]:
             tstart = int(start.timestamp())
             tend = int(end.timestamp())
             notes = request.form["notes"]
-            assert (
-                con.execute(
-                    "INSERT INTO meetings (mentor, time_start, time_end, notes) VALUES (?, ?, ?, ?)",
-                    (username, tstart, tend, notes),
-                ).rowcount
-                == 1
+            cur = con.execute(
+                "INSERT INTO meetings (mentor, time_start, time_end, notes) VALUES (?, ?, ?, ?)",
+                (username, tstart, tend, notes),
             )
+            assert cur.rowcount == 1 and cur.lastrowid is not None
+            record_meeting_change(cur.lastrowid, "insert")
+            count_meeting(cur.lastrowid, 1)
             con.commit()
+            meetings_changed()
             return render_template(
                 "enlist.html",
                 lfmu=lfmu,
@@ -497,7 +1119,7 @@ def index() -> Union[str, Response, werkzeugResponse]:
         try:
             if request.form["action"] == "deregister_meeting":
                 res = con.execute(
-                    "SELECT mentor, mentee FROM meetings WHERE mid = ?",
+                    "SELECT mentor, mentee, time_start FROM meetings WHERE mid = ?",
                     (request.form["mid"],),
                 ).fetchall()
                 if len(res) != 1:
@@ -506,8 +1128,18 @@ def index() -> Union[str, Response, werkzeugResponse]:
                         % request.form["mid"]
                     )
                 else:
-                    mentor, mentee = res[0]
+                    mentor, mentee, time_start = res[0]
                     if username == mentor:
+                        record_meeting_change(request.form["mid"], "delete")
+                        count_meeting(request.form["mid"], -1)
+                        queue_meeting_mail(
+                            mentee,
+                            username,
+                            request.form["mid"],
+                            time_start,
+                            "cancelled",
+                            request.form.get("reason", ""),
+                        )
                         assert (
                             con.execute(
                                 "DELETE FROM meetings WHERE mid = ?",
@@ -516,12 +1148,23 @@ def index() -> Union[str, Response, werkzeugResponse]:
                             == 1
                         )
                         con.commit()
+                        meetings_changed()
+                        outbox_wakeup.set()
                         snotes.append(
                             "You have deregistered from, and deleted, meeting %s"
                             % request.form["mid"]
                         )
-                        # somehow notify mentee with request.form["reason"]
                     elif username == mentee:
+                        record_meeting_change(request.form["mid"], "release")
+                        count_meeting(request.form["mid"], -1)
+                        queue_meeting_mail(
+                            mentor,
+                            username,
+                            request.form["mid"],
+                            time_start,
+                            "deregistered from",
+                            request.form.get("reason", ""),
+                        )
                         assert (
                             con.execute(
                                 "UPDATE meetings SET mentee = NULL WHERE mid = ?",
@@ -529,18 +1172,30 @@ def index() -> Union[str, Response, werkzeugResponse]:
                             ).rowcount
                             == 1
                         )
+                        count_meeting(request.form["mid"], 1)
                         con.commit()
+                        meetings_changed()
+                        outbox_wakeup.set()
                         snotes.append(
                             "You have deregistered from meeting %s"
                             % request.form["mid"]
                         )
-                        # somehow notify mentor with request.form["reason"]
                     else:
                         snotes.append(
                             "You tried to deregister from meeting %s but it doesn't even exist or you don't have permissions"
                             % request.form["mid"]
                         )
             elif request.form["action"] == "expertise":
+                # The summaries attribute meetings to their mentor's subjects
+                # and year group, so move this mentor's meetings across.
+                mids = [
+                    r[0]
+                    for r in con.execute(
+                        "SELECT mid FROM meetings WHERE mentor = ?", (username,)
+                    ).fetchall()
+                ]
+                for mid in mids:
+                    count_meeting(mid, -1)
                 con.execute(
                     "DELETE FROM subject_associations WHERE username = ?",
                     (username,),
@@ -555,6 +1210,8 @@ def index() -> Union[str, Response, werkzeugResponse]:
                         "UPDATE users SET year = ? WHERE USERNAME = ?",
                         (year, username),
                     )
+                    for mid in mids:
+                        count_meeting(mid, 1)
                     explode = False
                 else:
                     explode = True
@@ -570,7 +1227,7 @@ def index() -> Union[str, Response, werkzeugResponse]:
                     )
             elif request.form["action"] == "register_meeting":
                 res = con.execute(
-                    "SELECT mentor, mentee FROM meetings WHERE mid = ?",
+                    "SELECT mentor, mentee, time_start FROM meetings WHERE mid = ?",
                     (request.form["mid"],),
                 ).fetchall()
                 if len(res) != 1 or res[0][1]:
@@ -580,6 +1237,7 @@ def index() -> Union[str, Response, werkzeugResponse]:
                 elif username == res[0][0]:
                     snotes.append("NEIN DANKE")
                 else:
+                    count_meeting(request.form["mid"], -1)
                     assert (
                         con.execute(
                             "UPDATE meetings SET mentee = ? WHERE mid = ?",
@@ -590,11 +1248,21 @@ def index() -> Union[str, Response, werkzeugResponse]:
                         ).rowcount
                         == 1
                     )
+                    record_meeting_change(request.form["mid"], "claim")
+                    count_meeting(request.form["mid"], 1)
+                    queue_meeting_mail(
+                        res[0][0],
+                        username,
+                        request.form["mid"],
+                        res[0][2],
+                        "registered for",
+                    )
                     con.commit()
+                    meetings_changed()
+                    outbox_wakeup.set()
                     snotes.append(
                         "You have registered for meeting %s" % request.form["mid"]
                     )
-                    # somehow notify mentor
             else:
                 return "this is not american politics"
         except KeyError:
@@ -665,6 +1333,7 @@ def check_powerschool(username: str, password: str) -> tuple[str, str, str]:
 
 
 @app.route("/login", methods=["GET", "POST"])
+@rate_limited
 def login() -> Union[Response, werkzeugResponse, str]:
     if request.method == "GET":
         logging.debug("GET on /login")
@@ -767,6 +1436,95 @@ def login() -> Union[Response, werkzeugResponse, str]:
     return response
 
 
+@app.route("/limits.json")
+def limits_json() -> Union[Dict[str, Any], Tuple[Dict[str, Any], int]]:
+    try:
+        username = check_cookie(request.cookies.get("session-id"))
+    except AuthenticationFault:
+        username = ""
+    if not (request.remote_addr == "127.0.0.1" or username in ADMINS):
+        return {"error": "administrators only"}, 403
+    with buckets_lock:
+        return {"rejections": dict(rejections), "buckets": len(buckets)}
+
+
+@app.route("/stats")
+def stats() -> Union[Response, werkzeugResponse, str, Tuple[str, int]]:
+    try:
+        username = check_cookie(request.cookies.get("session-id"))
+    except AuthenticationFault:
+        username = ""
+    if not (request.remote_addr == "127.0.0.1" or username in ADMINS):
+        return "You may not access this resource.", 403
+    snotes: List[Union[str, Markup]] = []
+    if request.args.get("check"):
+        # This one is a full recomputation, so it is only done when asked.
+        problems = check_meeting_stats()
+        snotes.extend(problems or ["The summaries match a full recomputation."])
+
+    this_week = date.today() - timedelta(days=date.today().weekday())
+    # The summaries cannot tell which of this week's unclaimed slots have
+    # already ended, so count those directly; a week of meetings is bounded.
+    week_start = datetime.combine(this_week, datetime.min.time())
+    ended: Dict[Tuple[str, str], int] = {}
+    for subjectid, year, count in con.execute(
+        "SELECT coalesce(sa.subjectid, ''), coalesce(u.year, ''), count(*) FROM meetings AS m LEFT JOIN users AS u ON u.username = m.mentor LEFT JOIN subject_associations AS sa ON sa.username = m.mentor WHERE m.time_start >= ? AND m.time_start < ? AND m.time_end < ? AND coalesce(m.mentee, '') = '' GROUP BY 1, 2",
+        (
+            int(week_start.timestamp()),
+            int((week_start + timedelta(weeks=1)).timestamp()),
+            time(),
+        ),
+    ).fetchall():
+        ended[(subjectid, year)] = count
+    rows = []
+    for week, subjectid, subjectname, year, slots, claimed, latency_sum, latency_count in con.execute(
+        "SELECT week, meeting_stats.subjectid, subjectname, year, slots, claimed, latency_sum, latency_count FROM meeting_stats LEFT JOIN subjects ON subjects.subjectid = meeting_stats.subjectid WHERE week >= ? AND week <= ? AND slots > 0 ORDER BY week DESC, subjectname ASC, year ASC",
+        (
+            (this_week - timedelta(weeks=STATS_WEEKS_BACK)).isoformat(),
+            (this_week + timedelta(weeks=STATS_WEEKS_AHEAD)).isoformat(),
+        ),
+    ).fetchall():
+        unclaimed = slots - claimed
+        if week < this_week.isoformat():
+            expired = unclaimed
+        elif week == this_week.isoformat():
+            expired = ended.get((subjectid, year), 0)
+        else:
+            expired = 0
+        rows.append(
+            (
+                week,
+                subjectname or (subjectid and '"' + subjectid + '"') or "(None)",
+                year or "None",
+                slots,
+                claimed,
+                unclaimed - expired,
+                expired,
+                "%.1f" % (latency_sum / latency_count / 3600) if latency_count else "",
+            )
+        )
+    return render_template("stats.html", snotes=snotes, rows=rows)
+
+
+@app.route("/snapshot.db.gz")
+def snapshot() -> Union[Response, Tuple[str, int]]:
+    try:
+        username = check_cookie(request.cookies.get("session-id"))
+    except AuthenticationFault:
+        username = ""
+    if not (request.remote_addr == "127.0.0.1" or username in ADMINS):
+        return "You may not access this resource.", 403
+    snapshots = get_snapshots()
+    if not snapshots:
+        return "There are no snapshots yet.", 404
+    return send_from_directory(
+        os.path.abspath(SNAPSHOT_DIR),
+        snapshots[-1],
+        as_attachment=True,
+        mimetype="application/gzip",
+    )
+
+
 @app.route("/impersonate", methods=["GET", "POST"])
 def impersonate() -> Union[Response, werkzeugResponse, str, tuple[str, int]]:
     if not (
@@ -775,13 +1533,44 @@ def impersonate() -> Union[Response, werkzeugResponse, str, tuple[str, int]]:
     ):
         return "You may not access this resource. If you are an administrator, you must log in normally to your administrator account first, and only use /impersonate after logging in.", 403
     if request.method == "GET":
+        q = request.args.get("q", "").strip()
+        try:
+            page = min(max(int(request.args.get("page", 1)), 1), IMPERSONATE_MAX_PAGE)
+        except ValueError:
+            page = 1
+        # Prefix matches on the NOCASE indexes, so LIKE can use them; the
+        # extra row tells us whether there is a next page.
+        order = "ORDER BY lastname COLLATE NOCASE, firstname COLLATE NOCASE, middlename COLLATE NOCASE LIMIT ? OFFSET ?"
+        limits = (IMPERSONATE_PAGE + 1, (page - 1) * IMPERSONATE_PAGE)
+        if q:
+            pattern = re.sub(r"([\\%_])", r"\\\1", q) + "%"
+            res = con.execute(
+                "SELECT username, lastname, firstname, middlename FROM users WHERE lastname LIKE ? ESCAPE '\\' OR firstname LIKE ? ESCAPE '\\' OR username LIKE ? ESCAPE '\\' "
+                + order,
+                (pattern, pattern, pattern) + limits,
+            ).fetchall()
+        else:
+            res = con.execute(
+                "SELECT username, lastname, firstname, middlename FROM users " + order,
+                limits,
+            ).fetchall()
+        more = len(res) > IMPERSONATE_PAGE
+        res = res[:IMPERSONATE_PAGE]
+        subjects: Dict[str, List[str]] = {}
+        for username, subjectid in con.execute(
+            "SELECT username, subjectid FROM subject_associations WHERE username IN (%s)"
+            % ", ".join("?" * len(res)),
+            [r[0] for r in res],
+        ).fetchall():
+            subjects.setdefault(username, []).append(subjectid)
         return render_template(
             "impersonate.html",
+            q=q,
+            page=page,
+            more=more,
             users=[
-                (username, lastname + ", " + firstname + " " + middlename, " ".join([w[0] for w in con.execute("SELECT subjectid FROM subject_associations WHERE username = ?", (username,)).fetchall()]))
-                for (username, lastname, firstname, middlename) in con.execute(
-                    "SELECT username, lastname, firstname, middlename FROM users ORDER BY lastname, firstname, middlename ASC"
-                ).fetchall()
+                (username, lastname + ", " + firstname + " " + middlename, " ".join(subjects.get(username, [])))
+                for (username, lastname, firstname, middlename) in res
             ],
         )
     # From now on it's POST
@@ -798,7 +1587,29 @@ def impersonate() -> Union[Response, werkzeugResponse, str, tuple[str, int]]:
     return response
 
 
+# Only now that everything migrate() relies on is defined.
+migrate()
+
+
 if __name__ == "__main__":
+    if sys.argv[1:] == ["snapshot"]:
+        # Take a fresh snapshot and write it, compressed, to standard output.
+        with open(take_snapshot(), "rb") as f:
+            shutil.copyfileobj(f, sys.stdout.buffer)
+        sys.exit(0)
+    elif sys.argv[1:] == ["check-stats"]:
+        problems = check_meeting_stats()
+        for problem in problems:
+            print(problem)
+        sys.exit(1 if problems else 0)
+    elif sys.argv[1:] == ["rebuild-stats"]:
+        rebuild_meeting_stats()
+        sys.exit(0)
+    # With the reloader, only the child process that serves requests should
+    # dispatch mail and take snapshots.
+    if PRODUCTION or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_dispatcher()
+        start_snapshots()
     try:
         app.run(port=48139, debug=(not PRODUCTION), use_reloader=(not PRODUCTION))
     finally:
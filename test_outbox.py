@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+#
+# Tests for the mail outbox in server.py, against a local SMTP sink. Run with
+# "python -m unittest test_outbox" or "python -m pytest test_outbox.py".
+
+from __future__ import annotations
+
+import importlib
+import os
+import shutil
+import socket
+import socketserver
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+from time import time
+from types import ModuleType
+from typing import Any, List, Set, Tuple
+
+server: Any = None
+olddir = os.getcwd()
+tmpdir = ""
+
+
+def setUpModule() -> None:
+    # server.py opens yay.db in the working directory as it is imported.
+    global server, tmpdir
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    tmpdir = tempfile.mkdtemp()
+    os.chdir(tmpdir)
+    sys.modules.pop("server", None)
+    server = importlib.import_module("server")
+    assert isinstance(server, ModuleType)
+
+
+def tearDownModule() -> None:
+    server.con.close()
+    os.chdir(olddir)
+    shutil.rmtree(tmpdir)
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    # Just enough SMTP for smtplib: accepts everything except the recipients
+    # in server.refuse, and records each message with its connection number.
+    server: Sink
+
+    def reply(self, line: str) -> None:
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self) -> None:
+        with self.server.lock:
+            self.server.connections += 1
+            connection = self.server.connections
+        recipients: List[str] = []
+        self.reply("220 sink")
+        while True:
+            line = self.rfile.readline().decode().strip()
+            verb = line[:4].upper()
+            if not line:
+                return
+            elif verb == "MAIL":
+                recipients = []
+                self.reply("250 ok")
+            elif verb == "RCPT":
+                address = line[line.index("<") + 1 : line.index(">")]
+                if address in self.server.refuse:
+                    self.reply("550 no such user")
+                else:
+                    recipients.append(address)
+                    self.reply("250 ok")
+            elif verb == "DATA":
+                self.reply("354 go ahead")
+                data = []
+                while True:
+                    line = self.rfile.readline().decode()
+                    if line in (".\r\n", ""):
+                        break
+                    data.append(line)
+                with self.server.lock:
+                    self.server.messages.append(
+                        (connection, recipients, "".join(data))
+                    )
+                self.reply("250 ok")
+            elif verb == "QUIT":
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 sink")
+
+
+class Sink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), SinkHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.messages: List[Tuple[int, List[str], str]] = []
+        self.refuse: Set[str] = set()
+
+
+class OutboxTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.sink = Sink()
+        threading.Thread(target=self.sink.serve_forever, daemon=True).start()
+        server.SMTP_HOST = "127.0.0.1"
+        server.SMTP_PORT = self.sink.server_address[1]
+        server.OUTBOX_RATE = 1000.0
+        server.OUTBOX_BATCH = 2
+        server.OUTBOX_RETRY = 60
+        for table in ("users", "meetings", "meeting_changes", "meeting_stats", "outbox"):
+            server.con.execute("DELETE FROM %s" % table)
+        for username, lastname in (("s1", "Alpha"), ("s2", "Beta"), ("s3", "Gamma")):
+            server.con.execute(
+                "INSERT INTO users (username, lastname, firstname, middlename, cookie, cookietime, year) VALUES (?, ?, 'F', 'M', ?, ?, 'Y10')",
+                (username, lastname, "c" + username, time()),
+            )
+        server.con.commit()
+        self.dcon = sqlite3.connect("yay.db")
+
+    def tearDown(self) -> None:
+        self.dcon.close()
+        self.sink.shutdown()
+        self.sink.server_close()
+
+    def client(self, username: str) -> Any:
+        client = server.app.test_client()
+        client.set_cookie("session-id", "c" + username)
+        return client
+
+    def enlist(self) -> int:
+        cur = server.con.execute(
+            "INSERT INTO meetings (mentor, time_start, time_end, notes) VALUES ('s1', ?, ?, '')",
+            (int(time()) + 86400, int(time()) + 90000),
+        )
+        server.record_meeting_change(cur.lastrowid, "insert")
+        server.count_meeting(cur.lastrowid, 1)
+        server.con.commit()
+        assert type(cur.lastrowid) is int
+        return cur.lastrowid
+
+    def queue(self, *recipients: str) -> None:
+        server.con.executemany(
+            "INSERT INTO outbox (recipient, subject, body, created, attempts, next_attempt) VALUES (?, 'subject', 'body', 0, 0, 0)",
+            [(r,) for r in recipients],
+        )
+        server.con.commit()
+
+    def test_meeting_mails_in_batches(self) -> None:
+        first, second = self.enlist(), self.enlist()
+        self.client("s2").post("/", data={"action": "register_meeting", "mid": first})
+        self.client("s3").post("/", data={"action": "register_meeting", "mid": second})
+        self.client("s2").post(
+            "/",
+            data={
+                "action": "deregister_meeting",
+                "mid": first,
+                "reason": "I have a clash with a test",
+            },
+        )
+        self.assertEqual(self.sink.messages, [])  # nothing is sent in the request
+
+        server.send_outbox(self.dcon)
+        self.assertEqual(
+            [m[1] for m in self.sink.messages], [["s1@ykpaoschool.cn"]] * 3
+        )
+        # Three mails, two per batch: two connections, the first one reused.
+        self.assertEqual([m[0] for m in self.sink.messages], [1, 1, 2])
+        self.assertIn("Beta, F M registered for", self.sink.messages[0][2])
+        self.assertIn("Gamma, F M registered for", self.sink.messages[1][2])
+        self.assertIn("Beta, F M deregistered from", self.sink.messages[2][2])
+        self.assertIn("I have a clash with a test", self.sink.messages[2][2])
+        self.assertEqual(
+            self.dcon.execute(
+                "SELECT count(*) FROM outbox WHERE sent IS NULL"
+            ).fetchone()[0],
+            0,
+        )
+
+    def test_refused_recipient_does_not_stop_batch(self) -> None:
+        server.OUTBOX_BATCH = 3
+        self.sink.refuse.add("bad@ykpaoschool.cn")
+        self.queue("a@ykpaoschool.cn", "bad@ykpaoschool.cn", "b@ykpaoschool.cn")
+        before = time()
+        server.send_outbox(self.dcon)
+        self.assertEqual(
+            [(m[0], m[1]) for m in self.sink.messages],
+            [(1, ["a@ykpaoschool.cn"]), (1, ["b@ykpaoschool.cn"])],
+        )
+        attempts, next_attempt, sent = self.dcon.execute(
+            "SELECT attempts, next_attempt, sent FROM outbox WHERE recipient = 'bad@ykpaoschool.cn'"
+        ).fetchone()
+        self.assertEqual((attempts, sent), (1, None))
+        self.assertGreaterEqual(next_attempt, before + server.OUTBOX_RETRY)
+
+    def test_unreachable_server_backs_off(self) -> None:
+        closed = socket.socket()
+        closed.bind(("127.0.0.1", 0))
+        server.SMTP_PORT = closed.getsockname()[1]
+        closed.close()
+        self.queue("a@ykpaoschool.cn")
+
+        for attempt in range(1, 4):
+            before = time()
+            with self.assertLogs(level="WARNING"):
+                server.send_outbox(self.dcon)
+            attempts, next_attempt = self.dcon.execute(
+                "SELECT attempts, next_attempt FROM outbox"
+            ).fetchone()
+            self.assertEqual(attempts, attempt)
+            delay = server.OUTBOX_RETRY * 2 ** (attempt - 1)
+            self.assertGreaterEqual(next_attempt, before + delay)
+            self.assertLess(next_attempt, time() + delay + 1)
+            # Not due yet, so another scan leaves it alone.
+            server.send_outbox(self.dcon)
+            self.assertEqual(
+                self.dcon.execute("SELECT attempts FROM outbox").fetchone()[0],
+                attempt,
+            )
+            self.dcon.execute("UPDATE outbox SET next_attempt = 0")
+            self.dcon.commit()
+        self.assertEqual(self.sink.messages, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
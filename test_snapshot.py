@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#
+# Tests for the online snapshots in server.py. Run with
+# "python -m unittest test_snapshot" or "python -m pytest test_snapshot.py".
+
+from __future__ import annotations
+
+import gzip
+import importlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import threading
+import unittest
+from math import ceil
+from time import sleep, time
+from types import ModuleType
+from typing import Any, List
+
+ROWS = 2000
+
+server: Any = None
+olddir = os.getcwd()
+tmpdir = ""
+
+
+def setUpModule() -> None:
+    # server.py opens yay.db in the working directory as it is imported.
+    global server, tmpdir
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    tmpdir = tempfile.mkdtemp()
+    os.chdir(tmpdir)
+    sys.modules.pop("server", None)
+    server = importlib.import_module("server")
+    assert isinstance(server, ModuleType)
+
+
+def tearDownModule() -> None:
+    server.con.close()
+    os.chdir(olddir)
+    shutil.rmtree(tmpdir)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self) -> None:
+        shutil.rmtree(server.SNAPSHOT_DIR, ignore_errors=True)
+        server.con.execute("DELETE FROM meetings")
+        # Each write below adds a row and lengthens the notes of meeting 1 in
+        # one transaction, so a consistent copy has as many extra rows as
+        # meeting 1 has extra characters.
+        server.con.executemany(
+            "INSERT INTO meetings (mid, mentor, time_start, time_end, notes) VALUES (?, 's1', 0, 1, ?)",
+            [(i + 1, "x" * 500) for i in range(ROWS)],
+        )
+        server.con.commit()
+        server.SNAPSHOT_KEEP = 3
+        server.SNAPSHOT_PAGES = 8
+        server.SNAPSHOT_SLEEP = 0.001
+        server.SNAPSHOT_RESTARTS = 50
+        self.stop = threading.Event()
+        self.writes = 0
+
+    def tearDown(self) -> None:
+        self.stop.set()
+
+    def write(self, pause: float) -> None:
+        w = sqlite3.connect("yay.db", timeout=10)
+        while not self.stop.is_set():
+            w.execute(
+                "INSERT INTO meetings (mentor, time_start, time_end, notes) VALUES ('s2', 0, 1, '')"
+            )
+            w.execute("UPDATE meetings SET notes = notes || 'y' WHERE mid = 1")
+            w.commit()
+            self.writes += 1
+            sleep(pause)
+        w.close()
+
+    def start_writer(self, pause: float) -> threading.Thread:
+        writer = threading.Thread(target=self.write, args=(pause,))
+        writer.start()
+        while not self.writes:
+            sleep(0.001)
+        return writer
+
+    def check_snapshots(self) -> List[int]:
+        counts = []
+        for name in server.get_snapshots():
+            path = os.path.join(tmpdir, "check.db")
+            with gzip.open(os.path.join(server.SNAPSHOT_DIR, name)) as g, open(
+                path, "wb"
+            ) as f:
+                shutil.copyfileobj(g, f)
+            c = sqlite3.connect(path)
+            try:
+                self.assertEqual(
+                    c.execute("PRAGMA integrity_check").fetchall(), [("ok",)], name
+                )
+                count = c.execute("SELECT count(*) FROM meetings").fetchone()[0]
+                notes = c.execute(
+                    "SELECT notes FROM meetings WHERE mid = 1"
+                ).fetchone()[0]
+            finally:
+                c.close()
+                os.remove(path)
+            self.assertEqual(count - ROWS, len(notes) - 500, name)
+            counts.append(count)
+        return counts
+
+    def test_snapshots_under_concurrent_writes(self) -> None:
+        # Steps big enough for a copy to finish between some of the writes,
+        # while others still land mid-copy and restart it.
+        server.SNAPSHOT_PAGES = 64
+        writer = self.start_writer(0.005)
+        try:
+            for _ in range(5):
+                server.take_snapshot()
+        finally:
+            self.stop.set()
+            writer.join()
+        self.assertGreater(self.writes, 1)
+        self.assertEqual(len(server.get_snapshots()), server.SNAPSHOT_KEEP)
+        counts = self.check_snapshots()
+        self.assertEqual(counts, sorted(counts))
+
+    def test_sleeps_between_steps(self) -> None:
+        server.SNAPSHOT_PAGES = 4
+        server.SNAPSHOT_SLEEP = 0.01
+        pages = server.con.execute("PRAGMA page_count").fetchone()[0]
+        start = time()
+        server.take_snapshot()
+        steps = ceil(pages / server.SNAPSHOT_PAGES)
+        self.assertGreaterEqual(time() - start, (steps - 1) * server.SNAPSHOT_SLEEP)
+        self.check_snapshots()
+
+    def test_restart_cap(self) -> None:
+        server.SNAPSHOT_PAGES = 4
+        server.SNAPSHOT_SLEEP = 0.005
+        server.SNAPSHOT_RESTARTS = 0
+        writer = self.start_writer(0.001)
+        try:
+            with self.assertLogs(level="WARNING") as logs:
+                server.take_snapshot()
+        finally:
+            self.stop.set()
+            writer.join()
+        self.assertIn("copying in one step", "\n".join(logs.output))
+        self.check_snapshots()
+
+
+if __name__ == "__main__":
+    unittest.main()